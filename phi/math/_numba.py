@@ -0,0 +1,17 @@
+"""
+Optional Numba support shared by the fused NumPy kernels.
+
+Numba is installed with `pip install phiflow[numba]`.
+Without it, `njit` leaves functions uncompiled and `prange` is `range`.
+Kernel modules expose an `is_applicable()` test so that callers fall back to backend-independent code instead of running uncompiled kernels.
+"""
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*_args, **_kwargs):
+        return lambda function: function
+
+    prange = range
@@ -0,0 +1,92 @@
+"""
+Numba kernels that fuse the vector updates of conjugate gradient iterations on NumPy arrays.
+"""
+import numpy as np
+
+from ._numba import NUMBA_AVAILABLE, njit, prange
+
+
+def is_applicable(*tensors):
+    """ Tests whether all tensors are float32 or float64 NumPy arrays of the same type and Numba is installed. """
+    if not NUMBA_AVAILABLE:
+        return False
+    for tensor in tensors:
+        if not isinstance(tensor, np.ndarray) or tensor.dtype not in (np.float32, np.float64) or tensor.dtype != tensors[0].dtype:
+            return False
+    return True
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def cg_update(x, p, v, r, rr, rr_out, residual_max, accuracy):
+    """
+    Performs the vector updates of one conjugate gradient iteration in place, given `v = A·p`.
+    All arrays are batched and flattened to shape (batch, n).
+    Examples whose maximum residual does not exceed `accuracy` have converged and are left unchanged.
+
+    Per example, the step size requires one pass to compute p·v.
+    The updates of x and r, the new squared residual norm and the maximum residual are then computed in a single pass,
+    followed by one pass updating the search direction p.
+
+    :param x: current solution, updated in place
+    :param p: search direction, updated in place
+    :param v: A·p
+    :param r: residual, updated in place
+    :param rr: squared residual norm r·r per example
+    :param rr_out: receives the new squared residual norm per example
+    :param residual_max: maximum absolute residual per example, updated in place
+    :param accuracy: convergence threshold for the maximum residual. Negative values disable the check.
+    """
+    batch_size, n = x.shape
+    for b in range(batch_size):
+        if residual_max[b] <= accuracy:
+            rr_out[b] = rr[b]
+            continue
+        pv = 0.
+        for i in prange(n):
+            pv += p[b, i] * v[b, i]
+        alpha = rr[b] / pv if pv != 0 else 0.
+        rr_new = 0.
+        r_max = 0.
+        for i in prange(n):
+            x[b, i] += alpha * p[b, i]
+            r[b, i] -= alpha * v[b, i]
+            rr_new += r[b, i] * r[b, i]
+            r_max = max(r_max, abs(r[b, i]))
+        beta = rr_new / rr[b] if rr[b] != 0 else 0.
+        for i in prange(n):
+            p[b, i] = r[b, i] + beta * p[b, i]
+        rr_out[b] = rr_new
+        residual_max[b] = r_max
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def pcg_update(x, p, v, r, diagonal, rz, rz_out, residual_max, accuracy):
+    """
+    Like `cg_update()` but applies a Jacobi preconditioner, i.e. the search direction is updated using `z = diagonal * r`.
+    `diagonal` holds the inverse diagonal of A with shape (batch, n) where the batch dimension may be 1.
+
+    :param rz: r·z per example
+    :param rz_out: receives the new value of r·z per example
+    """
+    batch_size, n = x.shape
+    for b in range(batch_size):
+        if residual_max[b] <= accuracy:
+            rz_out[b] = rz[b]
+            continue
+        db = min(b, diagonal.shape[0] - 1)
+        pv = 0.
+        for i in prange(n):
+            pv += p[b, i] * v[b, i]
+        alpha = rz[b] / pv if pv != 0 else 0.
+        rz_new = 0.
+        r_max = 0.
+        for i in prange(n):
+            x[b, i] += alpha * p[b, i]
+            r[b, i] -= alpha * v[b, i]
+            rz_new += r[b, i] * r[b, i] * diagonal[db, i]
+            r_max = max(r_max, abs(r[b, i]))
+        beta = rz_new / rz[b] if rz[b] != 0 else 0.
+        for i in prange(n):
+            p[b, i] = diagonal[db, i] * r[b, i] + beta * p[b, i]
+        rz_out[b] = rz_new
+        residual_max[b] = r_max
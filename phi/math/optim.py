@@ -1,6 +1,9 @@
 from collections import namedtuple
 
+import numpy as np
+
 from phi.backend.dynamic_backend import DYNAMIC_BACKEND as math
+from . import _optim_kernels
 
 
 SolveResult = namedtuple('SolveResult', ['iterations', 'x', 'residual'])
@@ -79,6 +82,89 @@ def conjugate_gradient(function, y, x0, accuracy=1e-5, max_iterations=1000, back
     return SolveResult(iterations_, x_, residual_)
 
 
+def conjugate_gradient_fused(function, y, x0, accuracy=1e-5, max_iterations=1000, back_prop=False, preconditioner=None):
+    """
+    Solve the linear system of equations `A·x=y` using the (preconditioned) conjugate gradient (CG) algorithm.
+    Takes the same arguments as `conjugate_gradient()` but uses the classic formulation of CG which tracks the residual norm
+    and requires only two reductions and one application of A per iteration.
+
+    For NumPy arrays, if Numba is installed, the vector updates and reductions of each iteration are fused into single passes over the data.
+    This also applies to diagonal preconditioners.
+
+    Convergence is tracked per example. Examples that reach the desired accuracy are no longer updated while the remaining examples are being solved.
+
+    :param y: Desired output of `f(x)`
+    :param function: linear function of x that returns A·x
+    :param x0: initial guess for the value of x
+    :param accuracy: (optional) the algorithm terminates once |f(x)-y| ≤ accuracy for every entry. If None, the algorithm runs until `max_iterations` is reached.
+    :param max_iterations: (optional) maximum number of CG iterations to perform
+    :param back_prop: Whether to enable auto-differentiation. This induces a memory cost scaling with the number of iterations. Otherwise, the memory cost is constant.
+    :param preconditioner: (optional) approximation of the inverse of A. Either a tensor holding the inverse diagonal of A which is multiplied element-wise with the residual
+        or a linear function M_inv(residual). The batch dimension of a diagonal may be 1.
+    :return: SolveResult holding the result for x, the number of iterations performed and the final residual
+    """
+    y = math.to_float(y)
+    x0 = math.to_float(x0)
+    residual0 = y - function(x0)
+    if preconditioner is not None and not callable(preconditioner):
+        diagonal = math.cast(preconditioner, math.dtype(y))
+
+        def preconditioner(residual):
+            return diagonal * residual
+    else:
+        diagonal = None
+    if preconditioner is None and _optim_kernels.is_applicable(y, x0, residual0) or diagonal is not None and _optim_kernels.is_applicable(y, x0, residual0, diagonal):
+        return _numpy_conjugate_gradient(function, x0, residual0, diagonal, accuracy, max_iterations)
+    non_batch_dims = tuple(range(1, len(y.shape)))
+    precondition = preconditioner or (lambda residual: residual)
+    dx0 = math.copy(precondition(residual0), only_mutable=True)  # residual is updated in-place by the loop
+    rz0 = math.sum(residual0 * dx0, axis=non_batch_dims, keepdims=True)
+
+    def cg_loop(x, dx, residual, rz, iterations):
+        dy = function(dx)
+        step_size = math.divide_no_nan(rz, math.sum(dx * dy, axis=non_batch_dims, keepdims=True))
+        if accuracy is not None:
+            not_converged = math.to_float(math.max(math.abs(residual), axis=non_batch_dims, keepdims=True) > accuracy)
+            step_size *= not_converged
+        x += step_size * dx
+        residual -= step_size * dy
+        z = precondition(residual)
+        rz_next = math.sum(residual * z, axis=non_batch_dims, keepdims=True)
+        dx_next = z + math.divide_no_nan(rz_next, rz) * dx
+        dx = dx_next if accuracy is None else not_converged * dx_next + (1 - not_converged) * dx
+        return [x, dx, residual, rz_next, iterations + 1]
+
+    x_, _, residual_, _, iterations_ = math.while_loop(_max_residual_condition(2, accuracy), cg_loop, [x0, dx0, residual0, rz0, 0], back_prop=back_prop, name="ConjGradFused", maximum_iterations=max_iterations)
+    return SolveResult(iterations_, x_, residual_)
+
+
+def _numpy_conjugate_gradient(function, x0, residual0, diagonal, accuracy, max_iterations):
+    shape = x0.shape
+    batch_size = shape[0]
+    x = np.reshape(x0, (batch_size, -1))
+    residual = np.reshape(residual0, (batch_size, -1))
+    if diagonal is None:
+        dx = residual.copy()
+    else:
+        diagonal = np.reshape(diagonal, (diagonal.shape[0], -1))
+        dx = diagonal * residual
+    rz = np.sum(residual * dx, axis=1).astype(np.float64)
+    rz_next = np.empty_like(rz)
+    residual_max = np.max(np.abs(residual), axis=1).astype(np.float64)
+    iterations = 0
+    while accuracy is None or np.max(residual_max) > accuracy:
+        if max_iterations is not None and iterations == max_iterations:
+            break
+        dy = np.reshape(function(np.reshape(dx, shape)), (batch_size, -1))
+        if diagonal is None:
+            _optim_kernels.cg_update(x, dx, dy, residual, rz, rz_next, residual_max, -1. if accuracy is None else accuracy)
+        else:
+            _optim_kernels.pcg_update(x, dx, dy, residual, diagonal, rz, rz_next, residual_max, -1. if accuracy is None else accuracy)
+        rz, rz_next = rz_next, rz
+        iterations += 1
+    return SolveResult(iterations, np.reshape(x, shape), np.reshape(residual, shape))
+
+
 def _max_residual_condition(residual_index, accuracy):
     """continue if the maximum deviation from zero is bigger than desired accuracy"""
     if accuracy is None:
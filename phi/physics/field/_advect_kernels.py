@@ -0,0 +1,410 @@
+"""
+Numba kernels that fuse the backtrace and interpolation of semi-Lagrangian, MacCormack and RK4 advection for grids stored as NumPy arrays.
+"""
+from numbers import Number
+
+import numpy as np
+
+from phi.math._numba import NUMBA_AVAILABLE, njit, prange
+from phi.struct.tensorop import collapsed_gather_nd
+
+
+# Boundary codes, one per grid face
+CONSTANT = 0
+REPLICATE = 1
+CIRCULAR = 2
+_BOUNDARY_CODES = {'constant': CONSTANT, 'boundary': REPLICATE, 'periodic': CIRCULAR}
+
+
+def is_applicable(grid, *tensors, dtype=None):
+    """
+    Tests whether the fused kernels can be used for `grid` and the given tensors.
+    This requires Numba, a 2D or 3D grid and float32 or float64 NumPy arrays.
+
+    :param grid: CenteredGrid
+    :param tensors: additional tensors that will be passed to the kernel
+    :param dtype: (optional) data type the arrays will be cast to before they are passed to the kernel
+    :return: bool
+    """
+    if not NUMBA_AVAILABLE or grid.rank not in (2, 3):
+        return False
+    if not isinstance(grid.extrapolation_value, Number):
+        return False
+    for tensor in (grid.data,) + tensors:
+        if not isinstance(tensor, np.ndarray) or np.dtype(dtype or tensor.dtype) not in (np.float32, np.float64):
+            return False
+    return True
+
+
+def is_elementwise_applicable(*tensors):
+    """
+    Tests whether the element-wise kernels can be used for the given tensors.
+    This requires Numba and float32 or float64 NumPy arrays that all have the same shape and data type.
+
+    :param tensors: tensors that will be passed to the kernel
+    :return: bool
+    """
+    if not NUMBA_AVAILABLE:
+        return False
+    for tensor in tensors:
+        if not isinstance(tensor, np.ndarray) or tensor.dtype not in (np.float32, np.float64):
+            return False
+        if tensor.shape != tensors[0].shape or tensor.dtype != tensors[0].dtype:
+            return False
+    return True
+
+
+def boundary_codes(extrapolation, rank):
+    """
+    Encodes the extrapolation of a grid as an integer array holding one boundary code per face.
+
+    :param extrapolation: extrapolation of a CenteredGrid, string or struct of strings
+    :param rank: spatial rank of the grid
+    :return: int32 array of shape (rank, 2)
+    """
+    codes = np.empty((rank, 2), np.int32)
+    for dim in range(rank):
+        for upper in (0, 1):
+            codes[dim, upper] = _BOUNDARY_CODES[collapsed_gather_nd(extrapolation, [dim, upper])]
+    return codes
+
+
+def semi_lagrangian(grid, velocity, dt):
+    """
+    Semi-Lagrangian advection of `grid` that performs the backward lookup and the linear interpolation in a single pass.
+    The lookup coordinates are never stored.
+
+    :param grid: CenteredGrid holding NumPy data
+    :param velocity: velocity tensor sampled at the cell centers of `grid`, shape (batch, spatial dims..., rank)
+    :param dt: time increment
+    :return: advected data of `grid`
+    """
+    values = grid.data
+    rank = grid.rank
+    assert velocity.shape[1:] == values.shape[1:-1] + (rank,), 'velocity of shape %s does not match grid %s' % (velocity.shape, values.shape)
+    out = np.empty((_batch_size(values, velocity),) + values.shape[1:], values.dtype)
+    dt_dx = np.asarray(dt / np.asarray(grid.dx, np.float64), values.dtype)
+    codes = boundary_codes(grid.extrapolation, rank)
+    kernel = _semi_lagrangian_2d if rank == 2 else _semi_lagrangian_3d
+    kernel(values, velocity, dt_dx, codes, values.dtype.type(grid.extrapolation_value), out)
+    return out
+
+
+def mac_cormack(grid, velocity, dt, correction_strength):
+    """
+    MacCormack advection of `grid`.
+    After the semi-Lagrangian pass, a second kernel performs the inverse lookup, the correction and the clamping to the neighbourhood of the backward lookup
+    in a single pass so that neither the corrected field nor the clamping bounds are stored.
+
+    :param grid: CenteredGrid holding NumPy data
+    :param velocity: velocity tensor sampled at the cell centers of `grid`, shape (batch, spatial dims..., rank)
+    :param dt: time increment
+    :param correction_strength: the estimated error is multiplied by this factor before being applied
+    :return: advected data of `grid`
+    """
+    values = grid.data
+    rank = grid.rank
+    semi_la = semi_lagrangian(grid, velocity, dt)
+    out = np.empty_like(semi_la)
+    dt_dx = np.asarray(dt / np.asarray(grid.dx, np.float64), values.dtype)
+    codes = boundary_codes(grid.extrapolation, rank)
+    kernel = _mac_cormack_correct_2d if rank == 2 else _mac_cormack_correct_3d
+    kernel(values, semi_la, velocity, dt_dx, codes, values.dtype.type(grid.extrapolation_value), values.dtype.type(correction_strength), out)
+    return out
+
+
+def runge_kutta_4(points, velocity, dt):
+    """
+    Fourth-order Runge-Kutta integration of particle positions through a velocity grid.
+    All four velocity samples and their weighted sum are computed per particle so that no intermediate point sets are stored.
+
+    :param points: particle positions in world space, shape (batch, count, rank)
+    :param velocity: CenteredGrid holding NumPy data with one component per spatial dimension
+    :param dt: time increment
+    :return: advected particle positions
+    """
+    rank = velocity.rank
+    assert points.shape[-1] == rank == velocity.component_count
+    out = np.empty((_batch_size(points, velocity.data),) + points.shape[1:], points.dtype)
+    lower = np.asarray(velocity.box.lower, np.float64) * np.ones(rank)
+    dx = np.asarray(velocity.dx, np.float64) * np.ones(rank)
+    codes = boundary_codes(velocity.extrapolation, rank)
+    kernel = _runge_kutta_4_2d if rank == 2 else _runge_kutta_4_3d
+    kernel(points, velocity.data, lower, dx, codes, float(velocity.extrapolation_value), float(dt), out)
+    return out
+
+
+def runge_kutta_4_combine(points, k1, k2, k3, k4, dt):
+    """
+    Computes the final Runge-Kutta step `points + dt/6 * (k1 + 2 * (k2 + k3) + k4)` in a single pass without intermediate arrays.
+
+    :param points: particle positions
+    :param k1: velocity sampled at the first stage, same shape as `points`
+    :param k2: velocity sampled at the second stage, same shape as `points`
+    :param k3: velocity sampled at the third stage, same shape as `points`
+    :param k4: velocity sampled at the fourth stage, same shape as `points`
+    :param dt: time increment
+    :return: advected particle positions
+    """
+    out = np.empty(points.shape, points.dtype)
+    _runge_kutta_4_combine(*[np.ravel(tensor) for tensor in (points, k1, k2, k3, k4)], points.dtype.type(dt / 6.), np.ravel(out))
+    return out
+
+
+def _batch_size(*tensors):
+    """ Returns the batch size of the kernel output. Each tensor must have a batch size of 1 or the output batch size. """
+    batch_size = max(tensor.shape[0] for tensor in tensors)
+    for tensor in tensors:
+        assert tensor.shape[0] in (1, batch_size), 'Batch dimension 0 does not match: %s' % ', '.join(str(tensor.shape) for tensor in tensors)
+    return batch_size
+
+
+@njit(cache=True)
+def _wrap(index, size, lower, upper):
+    """ Maps a grid index into the valid range according to the face boundary codes. Returns -1 for constant extrapolation. """
+    if 0 <= index < size:
+        return index
+    code = lower if index < 0 else upper
+    if code == CIRCULAR:
+        return index % size
+    if code == REPLICATE:
+        return 0 if index < 0 else size - 1
+    return -1
+
+
+@njit(cache=True)
+def _lookup_2d(values, b, i, j, c, constant):
+    if i < 0 or j < 0:
+        return constant
+    return values[b, i, j, c]
+
+
+@njit(cache=True)
+def _lookup_3d(values, b, i, j, k, c, constant):
+    if i < 0 or j < 0 or k < 0:
+        return constant
+    return values[b, i, j, k, c]
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _semi_lagrangian_2d(values, velocity, dt_dx, codes, constant, out):
+    batch_size, n0, n1, components = out.shape
+    for i in prange(n0):
+        for b in range(batch_size):
+            bf = min(b, values.shape[0] - 1)
+            bv = min(b, velocity.shape[0] - 1)
+            for j in range(n1):
+                x = np.float32(i) - velocity[bv, i, j, 0] * dt_dx[0]
+                y = np.float32(j) - velocity[bv, i, j, 1] * dt_dx[1]
+                x_lo = np.floor(x)
+                y_lo = np.floor(y)
+                wx = x - x_lo
+                wy = y - y_lo
+                i0 = _wrap(int(x_lo), n0, codes[0, 0], codes[0, 1])
+                i1 = _wrap(int(x_lo) + 1, n0, codes[0, 0], codes[0, 1])
+                j0 = _wrap(int(y_lo), n1, codes[1, 0], codes[1, 1])
+                j1 = _wrap(int(y_lo) + 1, n1, codes[1, 0], codes[1, 1])
+                for c in range(components):
+                    lo = (np.float32(1) - wy) * _lookup_2d(values, bf, i0, j0, c, constant) + wy * _lookup_2d(values, bf, i0, j1, c, constant)
+                    hi = (np.float32(1) - wy) * _lookup_2d(values, bf, i1, j0, c, constant) + wy * _lookup_2d(values, bf, i1, j1, c, constant)
+                    out[b, i, j, c] = (np.float32(1) - wx) * lo + wx * hi
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _semi_lagrangian_3d(values, velocity, dt_dx, codes, constant, out):
+    batch_size, n0, n1, n2, components = out.shape
+    for i in prange(n0):
+        for b in range(batch_size):
+            bf = min(b, values.shape[0] - 1)
+            bv = min(b, velocity.shape[0] - 1)
+            for j in range(n1):
+                for k in range(n2):
+                    x = np.float32(i) - velocity[bv, i, j, k, 0] * dt_dx[0]
+                    y = np.float32(j) - velocity[bv, i, j, k, 1] * dt_dx[1]
+                    z = np.float32(k) - velocity[bv, i, j, k, 2] * dt_dx[2]
+                    x_lo = np.floor(x)
+                    y_lo = np.floor(y)
+                    z_lo = np.floor(z)
+                    wx = x - x_lo
+                    wy = y - y_lo
+                    wz = z - z_lo
+                    i0 = _wrap(int(x_lo), n0, codes[0, 0], codes[0, 1])
+                    i1 = _wrap(int(x_lo) + 1, n0, codes[0, 0], codes[0, 1])
+                    j0 = _wrap(int(y_lo), n1, codes[1, 0], codes[1, 1])
+                    j1 = _wrap(int(y_lo) + 1, n1, codes[1, 0], codes[1, 1])
+                    k0 = _wrap(int(z_lo), n2, codes[2, 0], codes[2, 1])
+                    k1 = _wrap(int(z_lo) + 1, n2, codes[2, 0], codes[2, 1])
+                    for c in range(components):
+                        v00 = (np.float32(1) - wz) * _lookup_3d(values, bf, i0, j0, k0, c, constant) + wz * _lookup_3d(values, bf, i0, j0, k1, c, constant)
+                        v01 = (np.float32(1) - wz) * _lookup_3d(values, bf, i0, j1, k0, c, constant) + wz * _lookup_3d(values, bf, i0, j1, k1, c, constant)
+                        v10 = (np.float32(1) - wz) * _lookup_3d(values, bf, i1, j0, k0, c, constant) + wz * _lookup_3d(values, bf, i1, j0, k1, c, constant)
+                        v11 = (np.float32(1) - wz) * _lookup_3d(values, bf, i1, j1, k0, c, constant) + wz * _lookup_3d(values, bf, i1, j1, k1, c, constant)
+                        lo = (np.float32(1) - wy) * v00 + wy * v01
+                        hi = (np.float32(1) - wy) * v10 + wy * v11
+                        out[b, i, j, k, c] = (np.float32(1) - wx) * lo + wx * hi
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _mac_cormack_correct_2d(values, semi_la, velocity, dt_dx, codes, constant, correction_strength, out):
+    batch_size, n0, n1, components = out.shape
+    for i in prange(n0):
+        for b in range(batch_size):
+            bf = min(b, values.shape[0] - 1)
+            bv = min(b, velocity.shape[0] - 1)
+            for j in range(n1):
+                dx = velocity[bv, i, j, 0] * dt_dx[0]
+                dy = velocity[bv, i, j, 1] * dt_dx[1]
+                for c in range(components):
+                    inverse = _interpolate_2d(semi_la, b, np.float32(i) + dx, np.float32(j) + dy, c, codes, constant)
+                    corrected = semi_la[b, i, j, c] + correction_strength * np.float32(0.5) * (values[bf, i, j, c] - inverse)
+                    lower, upper = _neighbour_range_2d(values, bf, np.float32(i) - dx, np.float32(j) - dy, c, codes, constant)
+                    out[b, i, j, c] = min(max(corrected, lower), upper)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _mac_cormack_correct_3d(values, semi_la, velocity, dt_dx, codes, constant, correction_strength, out):
+    batch_size, n0, n1, n2, components = out.shape
+    for i in prange(n0):
+        for b in range(batch_size):
+            bf = min(b, values.shape[0] - 1)
+            bv = min(b, velocity.shape[0] - 1)
+            for j in range(n1):
+                for k in range(n2):
+                    dx = velocity[bv, i, j, k, 0] * dt_dx[0]
+                    dy = velocity[bv, i, j, k, 1] * dt_dx[1]
+                    dz = velocity[bv, i, j, k, 2] * dt_dx[2]
+                    for c in range(components):
+                        inverse = _interpolate_3d(semi_la, b, np.float32(i) + dx, np.float32(j) + dy, np.float32(k) + dz, c, codes, constant)
+                        corrected = semi_la[b, i, j, k, c] + correction_strength * np.float32(0.5) * (values[bf, i, j, k, c] - inverse)
+                        lower, upper = _neighbour_range_3d(values, bf, np.float32(i) - dx, np.float32(j) - dy, np.float32(k) - dz, c, codes, constant)
+                        out[b, i, j, k, c] = min(max(corrected, lower), upper)
+
+
+@njit(cache=True)
+def _neighbour_range_2d(values, b, x, y, c, codes, constant):
+    """ Returns the minimum and maximum of the values that a linear interpolation at the grid index coordinates (x, y) would read. """
+    i0 = _wrap(int(np.floor(x)), values.shape[1], codes[0, 0], codes[0, 1])
+    i1 = _wrap(int(np.floor(x)) + 1, values.shape[1], codes[0, 0], codes[0, 1])
+    j0 = _wrap(int(np.floor(y)), values.shape[2], codes[1, 0], codes[1, 1])
+    j1 = _wrap(int(np.floor(y)) + 1, values.shape[2], codes[1, 0], codes[1, 1])
+    v00 = _lookup_2d(values, b, i0, j0, c, constant)
+    v01 = _lookup_2d(values, b, i0, j1, c, constant)
+    v10 = _lookup_2d(values, b, i1, j0, c, constant)
+    v11 = _lookup_2d(values, b, i1, j1, c, constant)
+    return min(min(v00, v01), min(v10, v11)), max(max(v00, v01), max(v10, v11))
+
+
+@njit(cache=True)
+def _neighbour_range_3d(values, b, x, y, z, c, codes, constant):
+    """ Like `_neighbour_range_2d()` for the grid index coordinates (x, y, z). """
+    lower = np.float32(np.inf)
+    upper = np.float32(-np.inf)
+    for di in range(2):
+        i = _wrap(int(np.floor(x)) + di, values.shape[1], codes[0, 0], codes[0, 1])
+        for dj in range(2):
+            j = _wrap(int(np.floor(y)) + dj, values.shape[2], codes[1, 0], codes[1, 1])
+            for dk in range(2):
+                k = _wrap(int(np.floor(z)) + dk, values.shape[3], codes[2, 0], codes[2, 1])
+                value = _lookup_3d(values, b, i, j, k, c, constant)
+                lower = min(lower, value)
+                upper = max(upper, value)
+    return lower, upper
+
+
+@njit(cache=True)
+def _interpolate_2d(values, b, x, y, c, codes, constant):
+    """ Linear interpolation of `values[b, ..., c]` at the grid index coordinates (x, y). """
+    x_lo = np.floor(x)
+    y_lo = np.floor(y)
+    wx = x - x_lo
+    wy = y - y_lo
+    i0 = _wrap(int(x_lo), values.shape[1], codes[0, 0], codes[0, 1])
+    i1 = _wrap(int(x_lo) + 1, values.shape[1], codes[0, 0], codes[0, 1])
+    j0 = _wrap(int(y_lo), values.shape[2], codes[1, 0], codes[1, 1])
+    j1 = _wrap(int(y_lo) + 1, values.shape[2], codes[1, 0], codes[1, 1])
+    lo = (np.float32(1) - wy) * _lookup_2d(values, b, i0, j0, c, constant) + wy * _lookup_2d(values, b, i0, j1, c, constant)
+    hi = (np.float32(1) - wy) * _lookup_2d(values, b, i1, j0, c, constant) + wy * _lookup_2d(values, b, i1, j1, c, constant)
+    return (np.float32(1) - wx) * lo + wx * hi
+
+
+@njit(cache=True)
+def _interpolate_3d(values, b, x, y, z, c, codes, constant):
+    """ Linear interpolation of `values[b, ..., c]` at the grid index coordinates (x, y, z). """
+    x_lo = np.floor(x)
+    y_lo = np.floor(y)
+    z_lo = np.floor(z)
+    wx = x - x_lo
+    wy = y - y_lo
+    wz = z - z_lo
+    i0 = _wrap(int(x_lo), values.shape[1], codes[0, 0], codes[0, 1])
+    i1 = _wrap(int(x_lo) + 1, values.shape[1], codes[0, 0], codes[0, 1])
+    j0 = _wrap(int(y_lo), values.shape[2], codes[1, 0], codes[1, 1])
+    j1 = _wrap(int(y_lo) + 1, values.shape[2], codes[1, 0], codes[1, 1])
+    k0 = _wrap(int(z_lo), values.shape[3], codes[2, 0], codes[2, 1])
+    k1 = _wrap(int(z_lo) + 1, values.shape[3], codes[2, 0], codes[2, 1])
+    v00 = (np.float32(1) - wz) * _lookup_3d(values, b, i0, j0, k0, c, constant) + wz * _lookup_3d(values, b, i0, j0, k1, c, constant)
+    v01 = (np.float32(1) - wz) * _lookup_3d(values, b, i0, j1, k0, c, constant) + wz * _lookup_3d(values, b, i0, j1, k1, c, constant)
+    v10 = (np.float32(1) - wz) * _lookup_3d(values, b, i1, j0, k0, c, constant) + wz * _lookup_3d(values, b, i1, j0, k1, c, constant)
+    v11 = (np.float32(1) - wz) * _lookup_3d(values, b, i1, j1, k0, c, constant) + wz * _lookup_3d(values, b, i1, j1, k1, c, constant)
+    return (np.float32(1) - wx) * ((np.float32(1) - wy) * v00 + wy * v01) + wx * ((np.float32(1) - wy) * v10 + wy * v11)
+
+
+@njit(cache=True)
+def _velocity_2d(values, b, x, y, lower, dx, codes, constant):
+    """ Samples the velocity grid at the world-space position (x, y). """
+    x = (x - lower[0]) / dx[0] - 0.5
+    y = (y - lower[1]) / dx[1] - 0.5
+    return _interpolate_2d(values, b, x, y, 0, codes, constant), _interpolate_2d(values, b, x, y, 1, codes, constant)
+
+
+@njit(cache=True)
+def _velocity_3d(values, b, x, y, z, lower, dx, codes, constant):
+    """ Samples the velocity grid at the world-space position (x, y, z). """
+    x = (x - lower[0]) / dx[0] - 0.5
+    y = (y - lower[1]) / dx[1] - 0.5
+    z = (z - lower[2]) / dx[2] - 0.5
+    return (_interpolate_3d(values, b, x, y, z, 0, codes, constant),
+            _interpolate_3d(values, b, x, y, z, 1, codes, constant),
+            _interpolate_3d(values, b, x, y, z, 2, codes, constant))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _runge_kutta_4_2d(points, values, lower, dx, codes, constant, dt, out):
+    batch_size, count, _ = out.shape
+    for p in prange(count):
+        for b in range(batch_size):
+            bp = min(b, points.shape[0] - 1)
+            bv = min(b, values.shape[0] - 1)
+            x = points[bp, p, 0]
+            y = points[bp, p, 1]
+            k1x, k1y = _velocity_2d(values, bv, x, y, lower, dx, codes, constant)
+            k2x, k2y = _velocity_2d(values, bv, x + 0.5 * dt * k1x, y + 0.5 * dt * k1y, lower, dx, codes, constant)
+            k3x, k3y = _velocity_2d(values, bv, x + 0.5 * dt * k2x, y + 0.5 * dt * k2y, lower, dx, codes, constant)
+            k4x, k4y = _velocity_2d(values, bv, x + dt * k3x, y + dt * k3y, lower, dx, codes, constant)
+            out[b, p, 0] = x + dt / 6. * (k1x + 2 * (k2x + k3x) + k4x)
+            out[b, p, 1] = y + dt / 6. * (k1y + 2 * (k2y + k3y) + k4y)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _runge_kutta_4_3d(points, values, lower, dx, codes, constant, dt, out):
+    batch_size, count, _ = out.shape
+    for p in prange(count):
+        for b in range(batch_size):
+            bp = min(b, points.shape[0] - 1)
+            bv = min(b, values.shape[0] - 1)
+            x = points[bp, p, 0]
+            y = points[bp, p, 1]
+            z = points[bp, p, 2]
+            k1x, k1y, k1z = _velocity_3d(values, bv, x, y, z, lower, dx, codes, constant)
+            k2x, k2y, k2z = _velocity_3d(values, bv, x + 0.5 * dt * k1x, y + 0.5 * dt * k1y, z + 0.5 * dt * k1z, lower, dx, codes, constant)
+            k3x, k3y, k3z = _velocity_3d(values, bv, x + 0.5 * dt * k2x, y + 0.5 * dt * k2y, z + 0.5 * dt * k2z, lower, dx, codes, constant)
+            k4x, k4y, k4z = _velocity_3d(values, bv, x + dt * k3x, y + dt * k3y, z + dt * k3z, lower, dx, codes, constant)
+            out[b, p, 0] = x + dt / 6. * (k1x + 2 * (k2x + k3x) + k4x)
+            out[b, p, 1] = y + dt / 6. * (k1y + 2 * (k2y + k3y) + k4y)
+            out[b, p, 2] = z + dt / 6. * (k1z + 2 * (k2z + k3z) + k4z)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _runge_kutta_4_combine(points, k1, k2, k3, k4, dt_6, out):
+    for i in prange(out.shape[0]):
+        out[i] = points[i] + dt_6 * (k1[i] + 2 * (k2[i] + k3[i]) + k4[i])
@@ -1,6 +1,18 @@
-from phi import math
+import itertools
+
+import numpy as np
+
+from phi import math, struct
+from phi.geom import AABox
 from phi.physics.field import SampledField, ConstantField, StaggeredGrid, CenteredGrid
 from .field import StaggeredSamplePoints, Field
+from .flag import SAMPLE_POINTS
+from . import _advect_kernels
+
+
+# Grids with more data than this are advected tile by tile so that the working set of each tile stays in the L2 cache.
+_L2_CACHE_BYTES = 1 << 20
+_TILE_CELLS = 1 << 18
 
 
 def advect(field, velocity, dt):
@@ -22,41 +34,57 @@ Advect `field` along the `velocity` vectors using the default advection method.
     raise NotImplementedError(field)
 
 
-def semi_lagrangian(field, velocity_field, dt):
+def semi_lagrangian(field, velocity_field, dt, advect_dtype=np.float32):
     """
     Semi-Lagrangian advection with simple backward lookup.
 
+    If Numba is installed and `field` holds NumPy data, lookup and interpolation are fused into a single kernel.
+
     :param field: Field to be advected
     :param velocity_field: vector field, need not be compatible with with `field`.
     :param dt: time increment
+    :param advect_dtype: floating point type used by the fused NumPy kernels. The result is cast back to the type of `field`. If None, the precision of `field` is kept.
     :return: Field compatible with input field
     """
     try:
         x0 = field.points
         v = velocity_field.at(x0)
+        if isinstance(field, CenteredGrid):
+            data = _advect_numpy(field, v.data, advect_dtype, [(_advect_kernels.is_applicable, _advect_kernels.semi_lagrangian)], dt)
+            if data is not None:
+                return field.with_data(data)
         x = x0 - v * dt
         data = field.sample_at(x.data)
         return field.with_data(data)
     except StaggeredSamplePoints:
-        advected = [semi_lagrangian(component, velocity_field, dt) for component in field.unstack()]
+        advected = [semi_lagrangian(component, velocity_field, dt, advect_dtype) for component in field.unstack()]
         return field.with_data(advected)
 
 
-def mac_cormack(field, velocity_field, dt, correction_strength=1.0):
+def mac_cormack(field, velocity_field, dt, correction_strength=1.0, advect_dtype=np.float32):
     """
     MacCormack advection uses a forward and backward lookup to determine the first-order error of semi-Lagrangian advection.
     It then uses that error estimate to correct the field values.
     To avoid overshoots, the resulting value is bounded by the neighbouring grid cells of the backward lookup.
 
+    NumPy grids are advected by fused Numba kernels if Numba is installed.
+    Otherwise, large NumPy grids are processed in tiles so that all lookups of one tile operate on cache-resident data.
+
     :param correction_strength: the estimated error is multiplied by this factor before being applied. The case correction_strength=0 equals semi-lagrangian advection. Set lower than 1.0 to avoid oscillations.
     :param field: Field to be advected
     :param velocity_field: vector field, need not be compatible with `field`.
     :param dt: time increment
+    :param advect_dtype: floating point type used for large NumPy grids. The result is cast back to the type of `field`. If None, the precision of `field` is kept.
     :return: Field compatible with input field
     """
     try:
         x0 = field.points
         v = velocity_field.at(x0)
+        if isinstance(field, CenteredGrid):
+            paths = [(_advect_kernels.is_applicable, _advect_kernels.mac_cormack), (_tiling_applicable, _mac_cormack_tiled)]
+            data = _advect_numpy(field, v.data, advect_dtype, paths, dt, correction_strength)
+            if data is not None:
+                return field.with_data(data)
         x_bwd = x0 - v * dt
         x_fwd = x0 + v * dt
         field_semi_la = field.with_data(field.sample_at(x_bwd.data))  # semi-Lagrangian advection
@@ -65,13 +93,102 @@ def mac_cormack(field, velocity_field, dt, correction_strength=1.0):
         field_clamped = math.clip(new_field, *field.general_sample_at(x_bwd.data, 'minmax'))  # Address overshoots
         return field_clamped
     except StaggeredSamplePoints:
-        advected = [mac_cormack(component, velocity_field, dt) for component in field.unstack()]
+        advected = [mac_cormack(component, velocity_field, dt, correction_strength, advect_dtype) for component in field.unstack()]
         return field.with_data(advected)
 
 
+def _advect_numpy(field, velocity, advect_dtype, paths, *args):
+    """
+    Advects the NumPy data of `field` using the first applicable path.
+    Floating point data is cast to `advect_dtype` once the path is chosen and the result is cast back to the type of `field`.
+
+    :param field: CenteredGrid
+    :param velocity: velocity tensor sampled at the cell centers of `field`
+    :param advect_dtype: floating point type to advect in or None to keep the precision of `field`
+    :param paths: sequence of (is_applicable, advect) functions. `is_applicable(field, velocity, dtype=dtype)` tests the data as if cast to `dtype`, `advect(field, velocity, *args)` returns the advected data.
+    :param args: additional arguments passed to `advect`
+    :return: advected data or None if no path is applicable
+    """
+    dtype = None
+    if advect_dtype is not None and all(isinstance(tensor, np.ndarray) and tensor.dtype.kind == 'f' for tensor in (field.data, velocity)):
+        dtype = np.dtype(advect_dtype)
+    for is_applicable, advect_path in paths:
+        if is_applicable(field, velocity, dtype=dtype):
+            if dtype is None:
+                return advect_path(field, velocity, *args)
+            data = advect_path(field.with_data(field.data.astype(dtype, copy=False)), velocity.astype(dtype, copy=False), *args)
+            return data.astype(field.data.dtype, copy=False)
+    return None
+
+
+def _tiling_applicable(field, velocity, dtype=None):
+    if not isinstance(field.data, np.ndarray) or not isinstance(velocity, np.ndarray):
+        return False
+    if field.data.size * np.dtype(dtype or field.data.dtype).itemsize <= _L2_CACHE_BYTES:
+        return False
+    return not np.any(np.char.equal(struct.flatten(field.extrapolation), 'periodic'))
+
+
+def _tile_iter(resolution, tile):
+    """
+    Splits a grid into blocks of at most `tile` cells along each axis.
+    :param resolution: grid resolution
+    :param tile: maximum block size per axis
+    :return: generator of tuples holding one slice per axis
+    """
+    starts = [range(0, res, size) for res, size in zip(resolution, tile)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(s, min(s + size, res)) for s, size, res in zip(start, tile, resolution))
+
+
+def _sub_box(field, slices):
+    """ Returns the box covering the cells `slices` of `field`. """
+    lower = [field.box.get_lower(axis) + sl.start * field.dx[axis] for axis, sl in enumerate(slices)]
+    upper = [field.box.get_lower(axis) + sl.stop * field.dx[axis] for axis, sl in enumerate(slices)]
+    return AABox(lower, upper)
+
+
+def _mac_cormack_tiled(field, velocity, dt, correction_strength, tile=None):
+    """
+    MacCormack advection of a non-periodic CenteredGrid, computed tile by tile.
+    The semi-Lagrangian field is only computed on the tile extended by a halo that covers the largest displacement, which is all the inverse lookup can reach.
+
+    :param field: CenteredGrid holding NumPy data
+    :param velocity: velocity sampled at the cell centers of `field`
+    :param tile: maximum tile size per axis
+    :return: advected data of `field` as NumPy array
+    """
+    resolution = [int(r) for r in field.resolution]
+    if tile is None:
+        tile = [int(round(_TILE_CELLS ** (1. / field.rank)))] * field.rank
+    max_displacement = np.max(np.abs(velocity) * abs(dt) / np.reshape(field.dx, [1] * (field.rank + 1) + [-1]))
+    halo = int(np.ceil(max_displacement)) + 1
+    values = field.data
+    points = field.points.data
+    result = np.empty((max(values.shape[0], velocity.shape[0]),) + values.shape[1:], values.dtype)
+    for tile_slices in _tile_iter(resolution, tile):
+        halo_slices = tuple(slice(max(0, sl.start - halo), min(res, sl.stop + halo)) for sl, res in zip(tile_slices, resolution))
+        inner = tuple(slice(sl.start - h.start, sl.stop - h.start) for sl, h in zip(tile_slices, halo_slices))
+        # --- Semi-Lagrangian advection of the tile and its halo ---
+        halo_box = _sub_box(field, halo_slices)
+        x0_halo = points[(slice(None),) + halo_slices]
+        x_bwd_halo = x0_halo - velocity[(slice(None),) + halo_slices] * dt
+        field_semi_la = CenteredGrid(field.sample_at(x_bwd_halo), box=halo_box, extrapolation=field.extrapolation, extrapolation_value=field.extrapolation_value)
+        # --- Inverse lookup, correction and clamping on the tile ---
+        x0 = x0_halo[(slice(None),) + inner]
+        x_bwd = x_bwd_halo[(slice(None),) + inner]
+        x_fwd = x0 + velocity[(slice(None),) + tile_slices] * dt
+        field_inv_semi_la = field_semi_la.sample_at(x_fwd)
+        new_values = field_semi_la.data[(slice(None),) + inner] + correction_strength * 0.5 * (values[(slice(None),) + tile_slices] - field_inv_semi_la)
+        lower, upper = field.general_sample_at(x_bwd, 'minmax')
+        result[(slice(None),) + tile_slices] = np.clip(new_values, lower, upper)  # Address overshoots
+    return result
+
+
 def runge_kutta_4(field, velocity, dt):
     """
 Lagrangian advection of particles.
+If `velocity` is a NumPy-backed CenteredGrid and Numba is installed, all four stages are evaluated in a single fused kernel.
     :param field: SampledField with any number of components
     :type field: SampledField
     :param velocity: Vector field
@@ -81,13 +198,33 @@ Lagrangian advection of particles.
     """
     assert isinstance(field, SampledField)
     assert isinstance(velocity, Field)
+    if isinstance(velocity, CenteredGrid) and velocity.component_count == velocity.rank and _advect_kernels.is_applicable(velocity, field.sample_points):
+        new_points = _advect_kernels.runge_kutta_4(field.sample_points, velocity, dt)
+        return SampledField(new_points, field.data, mode=field.mode, point_count=field._point_count, name=field.name)
     points = field.points
     # --- Sample velocity at intermediate points ---
     vel_k1 = velocity.at(points)
-    vel_k2 = velocity.at(points + 0.5 * dt * vel_k1)
-    vel_k3 = velocity.at(points + 0.5 * dt * vel_k2)
-    vel_k4 = velocity.at(points + dt * vel_k3)
+    vel_k2 = velocity.at(_sample_points(_euler_step(points.data, vel_k1.data, 0.5 * dt)))
+    vel_k3 = velocity.at(_sample_points(_euler_step(points.data, vel_k2.data, 0.5 * dt)))
+    vel_k4 = velocity.at(_sample_points(_euler_step(points.data, vel_k3.data, dt)))
     # --- Combine points with RK4 scheme ---
-    new_points = points + dt * (1 / 6.) * (vel_k1 + 2 * (vel_k2 + vel_k3) + vel_k4)
-    result = SampledField(new_points.data, field.data, mode=field.mode, point_count=field._point_count, name=field.name)
+    if _advect_kernels.is_elementwise_applicable(points.data, vel_k1.data, vel_k2.data, vel_k3.data, vel_k4.data):
+        new_points = _advect_kernels.runge_kutta_4_combine(points.data, vel_k1.data, vel_k2.data, vel_k3.data, vel_k4.data, dt)
+    else:
+        new_points = points.data + (dt / 6.) * (vel_k1.data + 2 * (vel_k2.data + vel_k3.data) + vel_k4.data)
+    result = SampledField(new_points, field.data, mode=field.mode, point_count=field._point_count, name=field.name)
     return result
+
+
+def _euler_step(points, velocity, dt):
+    """ Computes `points + dt * velocity`. For NumPy arrays, the result is the only array that is allocated. """
+    if isinstance(points, np.ndarray) and isinstance(velocity, np.ndarray) and points.shape == velocity.shape:
+        result = np.multiply(velocity, dt, dtype=np.result_type(points, velocity))
+        result += points
+        return result
+    return points + dt * velocity
+
+
+def _sample_points(locations):
+    """ Creates a SampledField that is sampled at `locations` and holds `locations` as data. """
+    return SampledField(locations, locations, flags=[SAMPLE_POINTS])
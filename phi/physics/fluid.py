@@ -2,13 +2,14 @@
 Definition of Fluid, IncompressibleFlow as well as fluid-related functions.
 """
 import warnings
+from collections import OrderedDict
 from numbers import Number
 
 import numpy as np
 import six
 
 from phi import math, struct
-from phi.geom import union
+from phi.geom import union, AABox, Sphere
 from phi.physics.field import Field, mask
 from phi.physics.field.angular_velocity import AngularVelocity
 
@@ -106,16 +107,61 @@ Supports obstacles, density effects, velocity effects, global gravity.
             density = effect_applied(effect, density, dt)
         for effect in velocity_effects:
             velocity = effect_applied(effect, velocity, dt)
-        velocity += (density * -gravity * fluid.buoyancy_factor * dt).at(velocity)
+        velocity = _add_buoyancy(velocity, density, gravity * (-fluid.buoyancy_factor * dt))
         divergent_velocity = velocity
         # --- Pressure solve ---
         if self.make_output_divfree:
-            velocity, solve_info = divergence_free(velocity, fluid.domain, obstacles, pressure_solver=self.pressure_solver, return_info=True)
+            velocity, solve_info = divergence_free(velocity, fluid.domain, obstacles, pressure_solver=self.pressure_solver, return_info=True, guess=_pressure_guess(fluid, velocity))
         solve_info['advected_velocity'] = advected_velocity
         solve_info['divergent_velocity'] = divergent_velocity
         return fluid.copied_with(density=density, velocity=velocity, age=fluid.age + dt, solve_info=solve_info)
 
 
+def _add_buoyancy(velocity, density, force):
+    """
+Adds `(density * force).at(velocity)` to `velocity`.
+If `density` is a scalar NumPy grid on the cell centers of `velocity` and `force` is a single vector,
+each face value is the mean of the two adjacent cells, scaled by the force along the face normal.
+Components without force are left unchanged.
+    :param velocity: StaggeredGrid
+    :param density: CenteredGrid
+    :param force: force per unit density, vector or tensor broadcastable to the components of `density * force`
+    :return: StaggeredGrid
+    """
+    if not _buoyancy_stencil_applicable(velocity, density, force):
+        return velocity + (density * force).at(velocity)
+    # The components of density * force are resampled with boundary extrapolation, see CenteredGrid.unstack()
+    density = density.copied_with(extrapolation='boundary')
+    components = []
+    for axis, (component, axis_force) in enumerate(zip(velocity.unstack(), np.reshape(force, -1))):
+        if axis_force == 0:
+            components.append(component)
+            continue
+        padded = density.axis_padded(axis, 1, 1).data
+        lower = padded[(slice(None),) * (axis + 1) + (slice(None, -1),)]
+        upper = padded[(slice(None),) * (axis + 1) + (slice(1, None),)]
+        components.append(component.with_data(component.data + (lower + upper) * (0.5 * axis_force)))
+    return velocity.with_data(components)
+
+
+def _buoyancy_stencil_applicable(velocity, density, force):
+    if not isinstance(density, CenteredGrid) or density.component_count != 1 or not isinstance(density.data, np.ndarray):
+        return False
+    if not isinstance(force, np.ndarray) or force.size != velocity.rank:
+        return False
+    if density.box != velocity.box or not np.all(density.resolution == velocity.resolution):
+        return False
+    return all(isinstance(component.data, np.ndarray) and component.data.shape[0] >= density.data.shape[0] for component in velocity.unstack())
+
+
+def _pressure_guess(fluid, velocity):
+    """ Returns the pressure of the previous step if it can be used as initial guess for the pressure solve of `velocity`. """
+    pressure = fluid.solve_info.get('pressure', None)
+    if isinstance(pressure, CenteredGrid) and pressure.compatible(velocity.center_points) and math.staticshape(pressure.data)[0] == math.staticshape(velocity.data[0].data)[0]:
+        return pressure
+    return None
+
+
 class IncompressibleVFlow(Physics):
 
     def __init__(self, boundaries, pressure_solver=None):
@@ -214,7 +260,7 @@ Computes the pressure from the given velocity divergence using the specified sol
     return poisson_solve(divergence, fluiddomain, solver=pressure_solver, guess=guess)
 
 
-def divergence_free(velocity, domain=None, obstacles=(), pressure_solver=None, return_info=False, gradient='implicit'):
+def divergence_free(velocity, domain=None, obstacles=(), pressure_solver=None, return_info=False, gradient='implicit', guess=None):
     """
 Projects the given velocity field by solving for and subtracting the pressure.
     :param return_info: if True, returns a dict holding information about the solve as a second object
@@ -222,30 +268,138 @@ Projects the given velocity field by solving for and subtracting the pressure.
     :param domain: Domain matching the velocity field, used for boundary conditions
     :param obstacles: list of Obstacles
     :param pressure_solver: PressureSolver. Uses default solver if none provided.
+    :param guess: (optional) CenteredGrid holding an initial guess for the pressure, e.g. the pressure returned by a previous call. Ignored by solvers that do not support guesses.
     :return: divergence-free velocity as StaggeredGrid
     """
     assert isinstance(velocity, StaggeredGrid)
     # --- Set up FluidDomain ---
     if domain is None:
         domain = Domain(velocity.resolution, OPEN)
-    obstacle_mask = mask(union([obstacle.geometry for obstacle in obstacles]), antialias=False)
-    if obstacle_mask is not None:
-        obstacle_grid = obstacle_mask.at(velocity.center_points).copied_with(extrapolation='constant')
-        active_mask = 1 - obstacle_grid
+        fluiddomain = _fluid_domain(velocity, domain, obstacles)
     else:
-        active_mask = math.ones(domain.centered_shape(name='active', extrapolation='constant'))
-    accessible_mask = active_mask.copied_with(extrapolation=Material.accessible_extrapolation_mode(domain.boundaries))
-    fluiddomain = FluidDomain(domain, active=active_mask, accessible=accessible_mask)
+        fluiddomain = _cached_fluid_domain(velocity, domain, obstacles)
     # --- Boundary Conditions, Pressure Solve ---
     velocity = fluiddomain.with_hard_boundary_conditions(velocity)
-    for obstacle in obstacles:
-        if not obstacle.is_stationary:
-            obs_mask = mask(obstacle.geometry, antialias=True)
-            angular_velocity = AngularVelocity(location=obstacle.geometry.center, strength=obstacle.angular_velocity, falloff=None)
-            velocity = ((1 - obs_mask) * velocity + obs_mask * (angular_velocity + obstacle.velocity)).at(velocity)
+    velocity = layer_obstacle_velocities(velocity, obstacles)
     divergence_field = velocity.divergence(physical_units=False)
-    pressure, iterations = poisson_solve(divergence_field, fluiddomain, solver=pressure_solver, gradient=gradient)
+    if guess is not None:
+        guess /= velocity.dx[0]
+    pressure, iterations = poisson_solve(divergence_field, fluiddomain, solver=pressure_solver, guess=guess, gradient=gradient)
     pressure *= velocity.dx[0]
     gradp = StaggeredGrid.gradient(pressure)
     velocity -= fluiddomain.with_hard_boundary_conditions(gradp)
     return velocity if not return_info else (velocity, {'pressure': pressure, 'iterations': iterations, 'divergence': divergence_field})
+
+
+def _fluid_domain(velocity, domain, obstacles):
+    geometries = [obstacle.geometry for obstacle in obstacles]
+    center_points = velocity.center_points
+    if len(geometries) > 1 and isinstance(center_points.data, np.ndarray) and all(_batchable_geometry(geometry) for geometry in geometries):
+        obstacle_grid = center_points.copied_with(data=_batched_union_mask(geometries, center_points.data), flags=(), extrapolation='constant')
+    else:
+        obstacle_mask = mask(union(geometries), antialias=False)
+        obstacle_grid = None if obstacle_mask is None else obstacle_mask.at(center_points).copied_with(extrapolation='constant')
+    if obstacle_grid is not None:
+        active_mask = 1 - obstacle_grid
+    else:
+        active_mask = math.ones(domain.centered_shape(name='active', extrapolation='constant'))
+    accessible_mask = active_mask.copied_with(extrapolation=Material.accessible_extrapolation_mode(domain.boundaries))
+    return FluidDomain(domain, active=active_mask, accessible=accessible_mask)
+
+
+def _batched_union_mask(geometries, points):
+    """
+Rasterizes the union of `geometries` at the regular grid `points`, equivalent to `mask(union(geometries)).sample_at(points)`.
+All obstacles of the same type are evaluated at once.
+Their signed distances are computed separably along each axis of the grid and min-reduced over the obstacles.
+    :param geometries: list of unbatched spheres and axis-aligned boxes with NumPy parameters, see `_batchable_geometry()`
+    :param points: NumPy array of shape (batch_size, spatial..., rank) holding the cell centers of a regular grid
+    :return: float NumPy array of shape (batch_size, spatial..., 1)
+    """
+    rank = points.shape[-1]
+    axis_coordinates = [points[(0,) + tuple(slice(None) if i == axis else 0 for i in range(rank)) + (axis,)] for axis in range(rank)]
+
+    def along_axis(values, axis):  # (obstacles, resolution[axis]) -> (obstacles, 1, ..., resolution[axis], ..., 1)
+        return np.reshape(values, (values.shape[0],) + tuple(-1 if i == axis else 1 for i in range(rank)))
+
+    assert all(_batchable_geometry(geometry) for geometry in geometries)
+    spheres = [geometry for geometry in geometries if isinstance(geometry, Sphere)]
+    boxes = [geometry for geometry in geometries if isinstance(geometry, AABox)]
+    distances = []
+    if spheres:
+        centers = np.stack([np.asarray(sphere.center, points.dtype) * np.ones(rank, points.dtype) for sphere in spheres])
+        radii = np.asarray([sphere.radius for sphere in spheres], points.dtype)
+        distance_squared = 0
+        for axis in range(rank):
+            distance_squared = distance_squared + along_axis((axis_coordinates[axis][None, :] - centers[:, axis:axis + 1]) ** 2, axis)
+        distances.append(distance_squared - np.reshape(radii ** 2, (-1,) + (1,) * rank))
+    if boxes:
+        lower = np.stack([np.asarray(box.lower, points.dtype) * np.ones(rank, points.dtype) for box in boxes])
+        upper = np.stack([np.asarray(box.upper, points.dtype) * np.ones(rank, points.dtype) for box in boxes])
+        box_distance = -np.inf
+        for axis in range(rank):
+            coordinates = axis_coordinates[axis][None, :]
+            box_distance = np.maximum(box_distance, along_axis(np.maximum(lower[:, axis:axis + 1] - coordinates, coordinates - upper[:, axis:axis + 1]), axis))
+        distances.append(box_distance)
+    inside = np.zeros(points.shape[:-1] + (1,), np.bool_)
+    if distances:
+        inside |= (np.min(np.concatenate([np.broadcast_to(d, (d.shape[0],) + points.shape[1:-1]) for d in distances]), axis=0) <= 0)[None, ..., None]
+    return inside.astype(points.dtype)
+
+
+def _batchable_geometry(geometry):
+    """ Tests whether `geometry` is an unbatched Sphere or AABox whose parameters are NumPy arrays or numbers, as required by `_batched_union_mask()`. """
+    if type(geometry) is Sphere:
+        return _numpy_parameters(geometry.center, geometry.radius, ndims=(1, 0))
+    if type(geometry) is AABox:
+        return _numpy_parameters(geometry.lower, geometry.upper, ndims=(1, 1))
+    return False
+
+
+def _numpy_parameters(*values, ndims):
+    for value, ndim in zip(values, ndims):
+        if not isinstance(value, (np.ndarray, Number, tuple, list)):
+            return False
+        value = np.asarray(value)
+        if value.dtype.kind not in 'fiu' or value.ndim > ndim:
+            return False
+    return True
+
+
+# FluidDomains of recent divergence_free() calls, keyed by the identities of the domain and the obstacle geometries
+_FLUID_DOMAIN_CACHE = OrderedDict()
+_FLUID_DOMAIN_CACHE_SIZE = 8
+
+
+def _cached_fluid_domain(velocity, domain, obstacles):
+    """
+Returns the FluidDomain for the given domain and obstacles, reusing the masks of previous calls if neither the domain nor any obstacle geometry was replaced.
+Cache entries reference the domain and geometries so that their ids cannot be reused while the entry exists.
+    """
+    geometries = tuple(obstacle.geometry for obstacle in obstacles)
+    key = (id(domain), tuple(id(geometry) for geometry in geometries))
+    if key in _FLUID_DOMAIN_CACHE:
+        _FLUID_DOMAIN_CACHE.move_to_end(key)
+        return _FLUID_DOMAIN_CACHE[key][-1]
+    fluiddomain = _fluid_domain(velocity, domain, obstacles)
+    _FLUID_DOMAIN_CACHE[key] = (domain, geometries, fluiddomain)
+    if len(_FLUID_DOMAIN_CACHE) > _FLUID_DOMAIN_CACHE_SIZE:
+        _FLUID_DOMAIN_CACHE.popitem(last=False)
+    return fluiddomain
+
+
+def layer_obstacle_velocities(velocity, obstacles):
+    """
+Sets the velocity inside moving obstacles to the obstacle velocity.
+Stationary obstacles are skipped and `velocity` is returned unchanged if no obstacle is moving.
+    :param velocity: StaggeredGrid
+    :param obstacles: list of Obstacles
+    :return: StaggeredGrid
+    """
+    moving = [obstacle for obstacle in obstacles if not obstacle.is_stationary]
+    for obstacle in moving:
+        obs_mask = mask(obstacle.geometry, antialias=True).at(velocity)
+        angular_velocity = AngularVelocity(location=obstacle.geometry.center, strength=obstacle.angular_velocity, falloff=None)
+        obs_velocity = (angular_velocity + obstacle.velocity).at(velocity)
+        velocity = velocity + obs_mask * (obs_velocity - velocity)
+    return velocity
@@ -0,0 +1,77 @@
+"""
+Numba kernel that evaluates the weighted Laplace stencil of `GeometricCG` in a single pass over NumPy arrays.
+"""
+import numpy as np
+
+from phi.math._numba import NUMBA_AVAILABLE, njit, prange
+
+
+def is_applicable(*tensors):
+    """ Tests whether Numba is installed and all tensors are 2D or 3D float32 or float64 NumPy arrays of shape (batch, spatial..., 1). """
+    if not NUMBA_AVAILABLE:
+        return False
+    for tensor in tensors:
+        if not isinstance(tensor, np.ndarray) or tensor.dtype not in (np.float32, np.float64) or tensor.ndim not in (4, 5):
+            return False
+    return True
+
+
+def stencil_coefficients(coefficients, diagonal):
+    """
+    Packs the stencil coefficients into one contiguous array for the kernels.
+
+    :param coefficients: list of (lower, upper) coefficient tensors, one pair per spatial dimension, each of shape (batch, spatial..., 1)
+    :param diagonal: tensor of shape (batch, spatial..., 1)
+    :return: array of shape (batch, spatial..., 2 * rank + 1) holding lower and upper coefficients per dimension followed by the diagonal
+    """
+    arrays = [coefficient for pair in coefficients for coefficient in pair] + [diagonal]
+    batch_size = max(array.shape[0] for array in arrays)
+    arrays = [np.broadcast_to(array, (batch_size,) + array.shape[1:]) for array in arrays]
+    return np.ascontiguousarray(np.concatenate(arrays, axis=-1))
+
+
+def weighted_laplace(padded, stencil):
+    """
+    Applies the weighted Laplace stencil to a padded scalar tensor in a single pass.
+
+    :param padded: tensor of shape (batch, spatial..., 1) with one padding cell at every face
+    :param stencil: coefficients as returned by `stencil_coefficients()`. The batch dimension may be 1.
+    :return: tensor of shape (batch, spatial..., 1) without padding
+    """
+    batch_size = max(padded.shape[0], stencil.shape[0])
+    out = np.empty((batch_size,) + stencil.shape[1:-1] + (1,), np.result_type(padded, stencil))
+    if padded.ndim == 4:
+        _weighted_laplace_2d(padded, stencil, out)
+    else:
+        _weighted_laplace_3d(padded, stencil, out)
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _weighted_laplace_2d(padded, stencil, out):
+    batch_size, size_x, size_y, _ = out.shape
+    for b in range(batch_size):
+        pb = min(b, padded.shape[0] - 1)
+        sb = min(b, stencil.shape[0] - 1)
+        for x in prange(size_x):
+            for y in range(size_y):
+                s = stencil[sb, x, y]
+                out[b, x, y, 0] = s[4] * padded[pb, x + 1, y + 1, 0]\
+                    + s[0] * padded[pb, x, y + 1, 0] + s[1] * padded[pb, x + 2, y + 1, 0]\
+                    + s[2] * padded[pb, x + 1, y, 0] + s[3] * padded[pb, x + 1, y + 2, 0]
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _weighted_laplace_3d(padded, stencil, out):
+    batch_size, size_x, size_y, size_z, _ = out.shape
+    for b in range(batch_size):
+        pb = min(b, padded.shape[0] - 1)
+        sb = min(b, stencil.shape[0] - 1)
+        for x in prange(size_x):
+            for y in range(size_y):
+                for z in range(size_z):
+                    s = stencil[sb, x, y, z]
+                    out[b, x, y, z, 0] = s[6] * padded[pb, x + 1, y + 1, z + 1, 0]\
+                        + s[0] * padded[pb, x, y + 1, z + 1, 0] + s[1] * padded[pb, x + 2, y + 1, z + 1, 0]\
+                        + s[2] * padded[pb, x + 1, y, z + 1, 0] + s[3] * padded[pb, x + 1, y + 2, z + 1, 0]\
+                        + s[4] * padded[pb, x + 1, y + 1, z, 0] + s[5] * padded[pb, x + 1, y + 1, z + 2, 0]
@@ -1,4 +1,8 @@
 # coding=utf-8
+import warnings
+
+import numpy as np
+
 from phi import math
 from phi import struct
 from phi.physics.domain import Domain
@@ -49,12 +53,29 @@ class PoissonSolver(object):
 PressureSolver = PoissonSolver
 
 
+def warn_if_not_converged(solver, solve_result, accuracy):
+    """
+    Issues a RuntimeWarning if an iterative solve stopped before all residuals reached `accuracy`, i.e. because the iteration limit was hit.
+    Only NumPy results are checked as symbolic tensors cannot be evaluated at this point.
+
+    :param solver: PoissonSolver that performed the solve
+    :param solve_result: SolveResult
+    :param accuracy: maximum allowed absolute residual or None
+    """
+    if accuracy is None or not isinstance(solve_result.residual, np.ndarray):
+        return
+    max_residual = np.max(np.abs(solve_result.residual))
+    if not max_residual <= accuracy:
+        warnings.warn('%s did not converge within %d iterations. Maximum residual %s exceeds accuracy %s.' % (solver, solve_result.iterations, max_residual, accuracy), RuntimeWarning)
+
+
 @struct.definition()
 class PoissonDomain(struct.Struct):
 
     def __init__(self, domain, valid_state=(), active=None, accessible=None, **kwargs):
         struct.Struct.__init__(self, **struct.kwargs(locals(), ignore='valid_state'))
         self._valid_state = valid_state
+        self._cache = {}
 
     @struct.constant()
     def domain(self, domain):
@@ -88,6 +109,24 @@ class PoissonDomain(struct.Struct):
     def rank(self):
         return self.domain.rank
 
+    def cached(self, key, compute):
+        """
+        Returns the value stored under `key`, evaluating `compute()` on first access.
+        Cached values are discarded when `domain`, `active` or `accessible` are replaced.
+
+        This allows masks and operators derived from this domain to be reused when the same PoissonDomain is passed to multiple solves.
+
+        :param key: hashable key
+        :param compute: function without arguments computing the value
+        :return: cached value
+        """
+        sources = (self.domain, self.active, self.accessible)
+        entry = self._cache.get(key)
+        if entry is None or any(cached is not source for cached, source in zip(entry[0], sources)):
+            entry = (sources, compute())
+            self._cache[key] = entry
+        return entry[1]
+
     def active_tensor(self, extend=0):
         """
         Scalar channel encoding active cells as ones and inactive (open/obstacle) as zero.
@@ -95,7 +134,7 @@ class PoissonDomain(struct.Struct):
 
         :param extend: Extend the grid in all directions beyond the grid size specified by the domain
         """
-        return self.active.padded([[extend, extend]] * self.rank).data
+        return self.cached(('active_tensor', extend), lambda: self.active.padded([[extend, extend]] * self.rank).data)
 
     def accessible_tensor(self, extend=0):
         """
@@ -103,23 +142,26 @@ class PoissonDomain(struct.Struct):
 
         :param extend: Extend the grid in all directions beyond the grid size specified by the domain
         """
-        pad_values = struct.map(lambda solid: int(not solid), Material.solid(self.domain.boundaries))
-        if isinstance(pad_values, (list, tuple)):
-            pad_values = [0] + list(pad_values) + [0]
-        result = math.pad(self.accessible.data, [[0,0]] + [[extend, extend]] * self.rank + [[0,0]], constant_values=pad_values)
-        return result
+        def accessible_tensor():
+            pad_values = struct.map(lambda solid: int(not solid), Material.solid(self.domain.boundaries))
+            if isinstance(pad_values, (list, tuple)):
+                pad_values = [0] + list(pad_values) + [0]
+            return math.pad(self.accessible.data, [[0,0]] + [[extend, extend]] * self.rank + [[0,0]], constant_values=pad_values)
+        return self.cached(('accessible_tensor', extend), accessible_tensor)
 
     def with_hard_boundary_conditions(self, velocity):
         masked = velocity * self._frictionless_velocity_mask(velocity)
         return masked  # TODO add surface velocity
 
     def _frictionless_velocity_mask(self, velocity):
-        tensors = []
-        for axis in range(velocity.rank):
-            upper = self.accessible.padded([[0, 1] if ax == axis else [0, 0] for ax in range(self.rank)])
-            lower = self.accessible.padded([[1, 0] if ax == axis else [0, 0] for ax in range(self.rank)])
-            tensors.append(math.minimum(upper.data, lower.data))
-        return velocity.with_data(tensors)
+        def frictionless_velocity_mask():
+            tensors = []
+            for axis in range(velocity.rank):
+                upper = self.accessible.padded([[0, 1] if ax == axis else [0, 0] for ax in range(self.rank)])
+                lower = self.accessible.padded([[1, 0] if ax == axis else [0, 0] for ax in range(self.rank)])
+                tensors.append(math.minimum(upper.data, lower.data))
+            return tensors
+        return velocity.with_data(list(self.cached('frictionless_velocity_mask', frictionless_velocity_mask)))
 
 
 FluidDomain = PoissonDomain
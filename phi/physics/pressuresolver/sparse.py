@@ -4,11 +4,11 @@ import scipy.sparse
 import scipy.sparse.linalg
 
 from phi import math
-from phi.math.blas import conjugate_gradient
+from phi.math.optim import conjugate_gradient_fused
 from phi.math.helper import _dim_shifted
 from phi.physics.material import Material
 from phi.struct.tensorop import collapsed_gather_nd
-from .solver_api import PoissonSolver, FluidDomain
+from .solver_api import PoissonSolver, FluidDomain, warn_if_not_converged
 
 
 class SparseSciPy(PoissonSolver):
@@ -23,7 +23,7 @@ class SparseSciPy(PoissonSolver):
     def solve(self, field, domain, guess, enable_backprop):
         assert isinstance(domain, FluidDomain)
         dimensions = list(field.shape[1:-1])
-        A = sparse_pressure_matrix(dimensions, domain.active_tensor(extend=1), domain.accessible_tensor(extend=1), Material.periodic(domain.domain.boundaries))
+        A = domain.cached('sparse_pressure_matrix', lambda: sparse_pressure_matrix(dimensions, domain.active_tensor(extend=1), domain.accessible_tensor(extend=1), Material.periodic(domain.domain.boundaries)))
 
         def np_solve_p(div):
             div_vec = div.reshape([-1, A.shape[0]])
@@ -39,13 +39,14 @@ class SparseSciPy(PoissonSolver):
 
 class SparseCG(PoissonSolver):
 
-    def __init__(self, accuracy=1e-5, max_iterations=2000):
+    def __init__(self, accuracy=1e-5, max_iterations=2000, preconditioner=None):
         """
         Conjugate gradient solver using sparse matrix multiplications.
 
         :param accuracy: the maximally allowed error for each cell, measured in terms of field values.
         :param gradient_accuracy: accuracy applied during backpropagation, number of 'same' to use forward accuracy
         :param max_iterations: integer specifying maximum conjugent gradient loop iterations or None for no limit
+        :param preconditioner: 'jacobi' to precondition the system with the inverse diagonal of the pressure matrix or None
         :param max_gradient_iterations: maximum loop iterations during backpropagation,
             'same' uses the number from max_iterations,
             'mirror' sets the maximum to the number of iterations that were actually performed in the forward pass
@@ -58,6 +59,8 @@ class SparseCG(PoissonSolver):
         assert math.is_scalar(accuracy), 'invalid accuracy: %s' % accuracy
         self.accuracy = accuracy
         self.max_iterations = max_iterations
+        assert preconditioner in (None, 'jacobi'), 'invalid preconditioner: %s' % preconditioner
+        self.preconditioner = preconditioner
 
     def solve(self, field, domain, guess, enable_backprop):
         assert isinstance(domain, FluidDomain)
@@ -68,7 +71,7 @@ class SparseCG(PoissonSolver):
         periodic = Material.periodic(domain.domain.boundaries)
 
         if math.choose_backend([field, active_mask, fluid_mask]).matches_name('SciPy'):
-            A = sparse_pressure_matrix(dimensions, active_mask, fluid_mask, periodic)
+            A = domain.cached('sparse_pressure_matrix', lambda: sparse_pressure_matrix(dimensions, active_mask, fluid_mask, periodic))
         else:
             sidx, sorting = sparse_indices(dimensions, periodic)
             sval_data = sparse_values(dimensions, active_mask, fluid_mask, sorting, periodic)
@@ -79,10 +82,18 @@ class SparseCG(PoissonSolver):
         div_vec = math.reshape(field, [-1, int(np.prod(field.shape[1:]))])
         if guess is not None:
             guess = math.reshape(guess, [-1, int(np.prod(field.shape[1:]))])
+        else:
+            guess = math.zeros_like(div_vec)
+
+        if self.preconditioner == 'jacobi':
+            preconditioner = math.reshape(1. / pressure_matrix_diagonal(fluid_mask), [-1, N])
+        else:
+            preconditioner = None
 
         def apply_A(pressure): return math.matmul(A, pressure)
-        result_vec, iterations = conjugate_gradient(div_vec, apply_A, guess, self.accuracy, self.max_iterations, enable_backprop)
-        return math.reshape(result_vec, math.shape(field)), iterations
+        result = conjugate_gradient_fused(apply_A, div_vec, guess, self.accuracy, self.max_iterations, enable_backprop, preconditioner=preconditioner)
+        warn_if_not_converged(self, result, self.accuracy)
+        return math.reshape(result.x, math.shape(field)), result.iterations
 
 
 def sparse_pressure_matrix(dimensions, extended_active_mask, extended_fluid_mask, periodic=False):
@@ -195,6 +206,20 @@ def sparse_values(dimensions, extended_active_mask, extended_fluid_mask, sorting
     return values
 
 
+def pressure_matrix_diagonal(extended_fluid_mask):
+    """
+    Computes the diagonal entries of the pressure matrix built by `sparse_pressure_matrix()` and `sparse_values()`.
+
+    :param extended_fluid_mask: Binary tensor with 2 more entries in every dimension than the pressure channel.
+    :return: tensor of the same shape as the pressure channel holding the diagonal matrix entries which are at most -1
+    """
+    diagonal_entries = 0
+    for dim in range(math.spatial_rank(extended_fluid_mask)):
+        lower_accessible, upper_accessible = _dim_shifted(extended_fluid_mask, dim, (-1, 1), diminish_others=(1, 1))
+        diagonal_entries += - lower_accessible - upper_accessible
+    return math.minimum(diagonal_entries, -1.)
+
+
 def wrap_or_discard(points, check_bounds_dim, dimensions, periodic=False):
     """
 Handles points that lie outside the domain by either discarding them or wrapping them, depending on periodic.
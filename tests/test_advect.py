@@ -0,0 +1,121 @@
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import numpy as np
+
+from phi import math
+from phi.geom import AABox
+from phi.physics.domain import Domain
+from phi.physics.field import CenteredGrid, Noise, SampledField, advect, _advect_kernels
+from phi.physics.field._advect_kernels import NUMBA_AVAILABLE
+from phi.physics.material import CLOSED, OPEN, PERIODIC
+
+
+def _generic_semi_lagrangian(field, velocity, dt):
+    x0 = field.points
+    x = x0 - velocity.at(x0) * dt
+    return field.with_data(field.sample_at(x.data))
+
+
+def _generic_runge_kutta_4(points, velocity, dt):
+    k1 = velocity.sample_at(points)
+    k2 = velocity.sample_at(points + 0.5 * dt * k1)
+    k3 = velocity.sample_at(points + 0.5 * dt * k2)
+    k4 = velocity.sample_at(points + dt * k3)
+    return points + dt / 6. * (k1 + 2 * (k2 + k3) + k4)
+
+
+class TestAdvect(TestCase):
+
+    def test_runge_kutta_4_staggered(self):
+        domain = Domain([16, 16], CLOSED)
+        velocity = CenteredGrid(0.1 * (CenteredGrid.getpoints(domain.box, domain.resolution).data - 8), box=domain.box).at(domain.staggered_grid(0))
+        particles = SampledField(np.random.uniform(6, 10, [1, 5, 2]))
+        advected = advect.runge_kutta_4(particles, velocity, dt=1.0)
+        np.testing.assert_allclose(advected.sample_points, 8 + (particles.sample_points - 8) * np.exp(0.1), atol=1e-4)
+
+    def test_mac_cormack_tiled(self):
+        for boundaries in (OPEN, CLOSED, [(CLOSED, OPEN), CLOSED]):
+            domain = Domain([20, 13], boundaries, box=AABox(0, [40, 13]))
+            field = CenteredGrid.sample(Noise(channels=2), domain)
+            velocity = domain.staggered_grid(Noise(channels=None)) * 3
+            expected = advect.mac_cormack(field, velocity, dt=1.5, correction_strength=0.8)
+            tiled = advect._mac_cormack_tiled(field, velocity.at(field.points).data, 1.5, 0.8, tile=(6, 4))
+            np.testing.assert_allclose(tiled, expected.data, atol=1e-5)
+
+
+@skipIf(not NUMBA_AVAILABLE, 'Numba is not installed')
+class TestAdvectKernels(TestCase):
+
+    def test_semi_lagrangian_2d(self):
+        for boundaries in (OPEN, CLOSED, PERIODIC, [(CLOSED, OPEN), PERIODIC]):
+            domain = Domain([16, 12], boundaries, box=AABox(0, [32, 12]))
+            field = CenteredGrid.sample(Noise(channels=2), domain)
+            velocity = domain.staggered_grid(Noise(channels=None)) * 3
+            advected = advect.semi_lagrangian(field, velocity, dt=1.5)
+            np.testing.assert_allclose(advected.data, _generic_semi_lagrangian(field, velocity, 1.5).data, atol=1e-5)
+
+    def test_semi_lagrangian_3d(self):
+        domain = Domain([8, 6, 7], CLOSED)
+        field = CenteredGrid.sample(Noise(), domain)
+        velocity = domain.staggered_grid(Noise(channels=None)) * 2
+        advected = advect.semi_lagrangian(field, velocity, dt=1.0)
+        np.testing.assert_allclose(advected.data, _generic_semi_lagrangian(field, velocity, 1.0).data, atol=1e-5)
+
+    def test_semi_lagrangian_batched_velocity(self):
+        domain = Domain([10, 10], OPEN)
+        field = CenteredGrid.sample(1.0, domain).copied_with(extrapolation='constant', extrapolation_value=0.5)
+        velocity = CenteredGrid(math.randn([3, 10, 10, 2]), box=domain.box)
+        advected = advect.semi_lagrangian(field, velocity, dt=2.0)
+        self.assertEqual(advected.data.shape, (3, 10, 10, 1))
+        np.testing.assert_allclose(advected.data, _generic_semi_lagrangian(field, velocity, 2.0).data, atol=1e-5)
+
+    def test_batch_mismatch(self):
+        domain = Domain([10, 10], OPEN)
+        field = CenteredGrid(math.randn([3, 10, 10, 1]), box=domain.box)
+        velocity = CenteredGrid(math.randn([2, 10, 10, 2]), box=domain.box)
+        self.assertRaises(AssertionError, _advect_kernels.semi_lagrangian, field, velocity.data, 1.0)
+        self.assertRaises(AssertionError, _advect_kernels.mac_cormack, field, velocity.data, 1.0, 1.0)
+        self.assertRaises(AssertionError, _advect_kernels.runge_kutta_4, np.random.uniform(2, 8, [3, 5, 2]), velocity, 1.0)
+
+    def test_semi_lagrangian_advect_dtype(self):
+        domain = Domain([16, 12], CLOSED)
+        velocity = domain.staggered_grid(Noise(channels=None)) * 3
+        field = CenteredGrid.sample(Noise(channels=2), domain)
+        field64 = field.with_data(field.data.astype(np.float64))
+        full_precision = advect.semi_lagrangian(field64, velocity, dt=1.5, advect_dtype=None)
+        for data in (field64.data, field.data.astype(np.float16)):
+            advected = advect.semi_lagrangian(field.with_data(data), velocity, dt=1.5)
+            self.assertEqual(advected.data.dtype, data.dtype)
+            np.testing.assert_allclose(advected.data, full_precision.data, atol=1e-5 if data.dtype == np.float64 else 1e-2)
+
+    def test_mac_cormack(self):
+        for resolution, boundaries in (([16, 12], [(CLOSED, OPEN), PERIODIC]), ([6, 5, 4], CLOSED)):
+            domain = Domain(resolution, boundaries)
+            field = CenteredGrid.sample(Noise(channels=2), domain)
+            velocity = domain.staggered_grid(Noise(channels=None)) * 2
+            with patch.object(_advect_kernels, 'is_applicable', return_value=False):
+                expected = advect.mac_cormack(field, velocity, dt=1.5, correction_strength=0.8)
+            advected = _advect_kernels.mac_cormack(field, velocity.at(field.points).data, 1.5, 0.8)
+            np.testing.assert_allclose(advected, expected.data, atol=1e-5)
+
+    def test_runge_kutta_4(self):
+        for rank in (2, 3):
+            domain = Domain([16] * rank, CLOSED)
+            coordinates = CenteredGrid.getpoints(domain.box, domain.resolution).data
+            velocity = CenteredGrid(0.1 * (coordinates - 8), box=domain.box)
+            particles = SampledField(np.random.uniform(6, 10, [2, 5, rank]))
+            advected = advect.runge_kutta_4(particles, velocity, dt=1.0)
+            np.testing.assert_allclose(advected.sample_points, 8 + (particles.sample_points - 8) * np.exp(0.1), atol=1e-4)
+            np.testing.assert_allclose(advected.sample_points, _generic_runge_kutta_4(particles.sample_points, velocity, 1.0), atol=1e-5)
+
+    def test_runge_kutta_4_combine(self):
+        points, k1, k2, k3, k4 = [np.random.randn(2, 50, 3).astype(np.float32) for _ in range(5)]
+        combined = _advect_kernels.runge_kutta_4_combine(points, k1, k2, k3, k4, dt=0.3)
+        np.testing.assert_allclose(combined, points + 0.3 / 6. * (k1 + 2 * (k2 + k3) + k4), atol=1e-5)
+        domain = Domain([16, 16], CLOSED)
+        velocity = domain.staggered_grid(Noise(channels=None))
+        particles = SampledField(np.random.uniform(2, 14, [1, 20, 2]).astype(np.float32))
+        advected = advect.runge_kutta_4(particles, velocity, dt=1.0)
+        np.testing.assert_allclose(advected.sample_points, _generic_runge_kutta_4(particles.sample_points, velocity, 1.0), atol=1e-5)
+
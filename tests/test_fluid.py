@@ -3,12 +3,13 @@ from unittest import TestCase
 import numpy
 
 from phi import struct, math
-from phi.geom import Sphere, AABox, box
+from phi.geom import Sphere, AABox, box, union
 from phi.physics.domain import Domain
-from phi.physics.field import StaggeredGrid, Noise
+from phi.physics.field import StaggeredGrid, Noise, mask
+from phi.physics.field.angular_velocity import AngularVelocity
 from phi.physics.field.effect import Fan, Inflow
 from phi.physics.material import CLOSED, OPEN
-from phi.physics.fluid import Fluid, INCOMPRESSIBLE_FLOW, IncompressibleFlow
+from phi.physics.fluid import Fluid, INCOMPRESSIBLE_FLOW, IncompressibleFlow, layer_obstacle_velocities, _cached_fluid_domain, divergence_free, _batched_union_mask, _batchable_geometry, _add_buoyancy
 from phi.physics.obstacle import Obstacle
 from phi.physics.pressuresolver.sparse import SparseCG
 from phi.physics.world import World
@@ -62,6 +63,58 @@ class TestFluid(TestCase):
         world.step(dt=0.5)
         assert fluid.age == fan.age == obstacle.age == 1.5
 
+    def test_layer_obstacle_velocities(self):
+        domain = Domain([16, 16])
+        velocity = domain.staggered_grid(Noise(channels=None))
+        self.assertIs(velocity, layer_obstacle_velocities(velocity, ()))
+        self.assertIs(velocity, layer_obstacle_velocities(velocity, [Obstacle(box[0:4, 0:4])]))
+        obstacle = Obstacle(Sphere((8, 8), 3), velocity=[1, -1], angular_velocity=0.5)
+        layered = layer_obstacle_velocities(velocity, [Obstacle(box[0:4, 0:4]), obstacle])
+        obs_mask = mask(obstacle.geometry, antialias=True)
+        angular_velocity = AngularVelocity(location=obstacle.geometry.center, strength=obstacle.angular_velocity, falloff=None)
+        expected = ((1 - obs_mask) * velocity + obs_mask * (angular_velocity + obstacle.velocity)).at(velocity)
+        for component, expected_component in zip(layered.data, expected.data):
+            numpy.testing.assert_allclose(component.data, expected_component.data, atol=1e-5)
+
+    def test_add_buoyancy(self):
+        for resolution in ([16, 12], [8, 7, 6]):
+            domain = Domain(resolution, [OPEN, CLOSED] + [CLOSED] * (len(resolution) - 2))
+            velocity = domain.staggered_grid(Noise(channels=None), batch_size=2)
+            density = domain.centered_grid(Noise(), batch_size=2)
+            force = numpy.reshape(numpy.arange(len(resolution), dtype=numpy.float32), [1] * (len(resolution) + 1) + [-1])
+            expected = velocity + (density * force).at(velocity)
+            for component, expected_component in zip(_add_buoyancy(velocity, density, force).data, expected.data):
+                numpy.testing.assert_allclose(component.data, expected_component.data, atol=1e-5)
+
+    def test_fluid_domain_cache(self):
+        domain = Domain([16, 16], CLOSED)
+        velocity = domain.staggered_grid(0)
+        obstacle = Obstacle(Sphere((8, 8), 3))
+        fluiddomain = _cached_fluid_domain(velocity, domain, [obstacle])
+        self.assertIs(fluiddomain, _cached_fluid_domain(velocity, domain, [obstacle.copied_with(age=1)]))
+        self.assertIsNot(fluiddomain, _cached_fluid_domain(velocity, domain, [obstacle.copied_with(geometry=Sphere((4, 4), 3))]))
+        self.assertIsNot(fluiddomain, _cached_fluid_domain(velocity, Domain([16, 16], CLOSED), [obstacle]))
+        self.assertIs(fluiddomain.accessible_tensor(extend=1), fluiddomain.accessible_tensor(extend=1))
+
+    def test_batched_union_mask(self):
+        for resolution in ([20, 17], [10, 9, 8]):
+            points = Domain(resolution, CLOSED).staggered_grid(0).center_points
+            rank = len(resolution)
+            geometries = [Sphere([5] * rank, 3), Sphere(numpy.array([12.5] * rank), 2.), AABox([0] * rank, [2.5] * rank), AABox([6] * rank, [8] * rank)]
+            expected = mask(union(geometries)).at(points).data
+            numpy.testing.assert_equal(_batched_union_mask(geometries, points.data), expected)
+            self.assertFalse(_batchable_geometry(Sphere(numpy.array([[3.] * rank]), 2.)))
+
+    def test_divergence_free_guess(self):
+        domain = Domain([32, 24], CLOSED, box=AABox(0, [64, 48]))
+        velocity = domain.staggered_grid(Noise(channels=None))
+        solver = SparseCG(accuracy=1e-5)
+        projected, info = divergence_free(velocity, domain, pressure_solver=solver, return_info=True)
+        warm, warm_info = divergence_free(velocity, domain, pressure_solver=solver, return_info=True, guess=info['pressure'])
+        self.assertLess(warm_info['iterations'], info['iterations'] // 2)
+        for component, warm_component in zip(projected.data, warm.data):
+            numpy.testing.assert_allclose(warm_component.data, component.data, atol=1e-3)
+
     def test_properties_dict(self):
         world = World()
         world.add(Fluid(Domain([16, 16])), physics=IncompressibleFlow())
@@ -0,0 +1,74 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from phi.math import _optim_kernels
+from phi.math.optim import conjugate_gradient, conjugate_gradient_fused
+
+
+def _spd_system(batch_size=2, n=20, dtype=np.float64):
+    np.random.seed(0)
+    matrix = np.random.randn(n, n)
+    matrix = matrix @ matrix.T + n * np.eye(n)
+    y = np.random.randn(batch_size, n).astype(dtype)
+    return (lambda x: np.einsum('ij,bj->bi', matrix, x).astype(dtype)), matrix, y
+
+
+class TestOptim(TestCase):
+
+    def test_conjugate_gradient_fused(self):
+        function, matrix, y = _spd_system()
+        expected = np.linalg.solve(matrix, y.T).T
+        result = conjugate_gradient_fused(function, y, np.zeros_like(y), accuracy=1e-8)
+        reference = conjugate_gradient(function, y, np.zeros_like(y), accuracy=1e-8)
+        np.testing.assert_allclose(result.x, expected, atol=1e-6)
+        np.testing.assert_allclose(result.x, reference.x, atol=1e-6)
+        self.assertLessEqual(np.max(np.abs(result.residual)), 1e-8)
+
+    def test_conjugate_gradient_fused_generic(self):
+        function, matrix, y = _spd_system(dtype=np.float32)
+        with patch.object(_optim_kernels, 'is_applicable', return_value=False):
+            generic = conjugate_gradient_fused(function, y, np.zeros_like(y), accuracy=1e-4)
+        fused = conjugate_gradient_fused(function, y, np.zeros_like(y), accuracy=1e-4)
+        np.testing.assert_allclose(generic.x, np.linalg.solve(matrix, y.T).T, atol=1e-4)
+        np.testing.assert_allclose(generic.x, fused.x, atol=1e-4)
+
+    def test_conjugate_gradient_fused_generic_iterations(self):
+        n = 200
+        laplace = lambda x: 2 * x - np.pad(x[:, 1:], [[0, 0], [0, 1]]) - np.pad(x[:, :-1], [[0, 0], [1, 0]])
+        y = np.random.RandomState(0).randn(1, n)
+        reference = conjugate_gradient(laplace, y, np.zeros_like(y), accuracy=1e-5)
+        with patch.object(_optim_kernels, 'is_applicable', return_value=False):
+            generic = conjugate_gradient_fused(laplace, y, np.zeros_like(y), accuracy=1e-5)
+        self.assertLessEqual(generic.iterations, reference.iterations + 2)
+        np.testing.assert_allclose(generic.x, reference.x, rtol=1e-3, atol=1e-3)
+
+    def test_conjugate_gradient_fused_max_iterations(self):
+        function, _, y = _spd_system()
+        result = conjugate_gradient_fused(function, y, np.zeros_like(y), accuracy=1e-12, max_iterations=3)
+        self.assertEqual(3, result.iterations)
+        result = conjugate_gradient_fused(function, y, np.zeros_like(y), accuracy=None, max_iterations=5)
+        self.assertEqual(5, result.iterations)
+
+    def test_preconditioned_conjugate_gradient(self):
+        function, matrix, y = _spd_system()
+        expected = np.linalg.solve(matrix, y.T).T
+        diagonal = 1 / np.diag(matrix)[np.newaxis, :]
+        for preconditioner in (diagonal, lambda residual: diagonal * residual):
+            result = conjugate_gradient_fused(function, y, np.zeros_like(y), accuracy=1e-8, preconditioner=preconditioner)
+            np.testing.assert_allclose(result.x, expected, atol=1e-6)
+        with patch.object(_optim_kernels, 'is_applicable', return_value=False):
+            result = conjugate_gradient_fused(function, y, np.zeros_like(y), accuracy=1e-8, preconditioner=diagonal)
+        np.testing.assert_allclose(result.x, expected, atol=1e-6)
+
+    def test_conjugate_gradient_fused_converged_examples_frozen(self):
+        function, matrix, y = _spd_system()
+        y[0] = 0
+        x0 = np.zeros_like(y)
+        x0[0] = 1e-9
+        for kernels_applicable in (True, False):
+            with patch.object(_optim_kernels, 'is_applicable', return_value=kernels_applicable and _optim_kernels.NUMBA_AVAILABLE):
+                result = conjugate_gradient_fused(function, y, x0, accuracy=1e-6)
+            np.testing.assert_equal(result.x[0], x0[0].astype(result.x.dtype))
+            np.testing.assert_allclose(result.x[1], np.linalg.solve(matrix, y[1]), atol=1e-5)
@@ -1,10 +1,12 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
+from unittest.mock import patch
 
 import numpy as np
 from phi import math
 
 from phi.flow import CLOSED, PERIODIC, OPEN, Domain, poisson_solve, Noise
-from phi.physics.pressuresolver.geom import GeometricCG
+from phi.physics.pressuresolver import _geom_kernels
+from phi.physics.pressuresolver.geom import GeometricCG, _make_weighted_laplace
 from phi.physics.pressuresolver.sparse import SparseCG, SparseSciPy
 from phi.physics.pressuresolver.fourier import FourierSolver
 from phi.physics.field import CenteredGrid
@@ -86,12 +88,38 @@ class TestPoissonSolve(TestCase):
 
     def test_sparse_cg(self):
         _test_all(SparseCG())
+        _test_all(SparseCG(preconditioner='jacobi'))
 
     def test_sparse_scipy(self):
         _test_all(SparseSciPy())
 
     def test_geometric_cg(self):
         _test_all(GeometricCG())
+        _test_all(GeometricCG(preconditioner='jacobi'))
+        _test_all(GeometricCG(preconditioner='chebyshev'))
+
+    def test_chebyshev_keeps_random_state(self):
+        domain = Domain([40, 32], boundaries=CLOSED)
+        div = domain.centered_grid(Noise())
+        state = np.random.get_state()
+        poisson_solve(div, domain, GeometricCG(preconditioner='chebyshev'))
+        np.testing.assert_equal(np.random.get_state()[1], state[1])
+
+    def test_not_converged_warning(self):
+        domain = Domain([40, 32], boundaries=CLOSED)
+        div = domain.centered_grid(Noise())
+        for solver in (SparseCG(max_iterations=3), GeometricCG(max_iterations=3)):
+            with self.assertWarns(RuntimeWarning):
+                poisson_solve(div, domain, solver)
+
+    @skipIf(not _geom_kernels.NUMBA_AVAILABLE, 'Numba is not installed')
+    def test_weighted_laplace_kernel(self):
+        for shape in ([6, 5], [4, 5, 3]):
+            weights = (np.random.rand(1, *[d + 2 for d in shape], 1) > 0.3).astype(np.float32)
+            tensor = np.random.randn(2, *[d + 2 for d in shape], 1).astype(np.float32)
+            with patch.object(_geom_kernels, 'is_applicable', return_value=False):
+                expected = _make_weighted_laplace(weights)(tensor)
+            np.testing.assert_allclose(_make_weighted_laplace(weights)(tensor), expected, atol=1e-5)
 
 
 # def _run_higher_order_fft_reconstruction(in_field, set_accuracy, tolerance=20, order=2):